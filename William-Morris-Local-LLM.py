@@ -1,7 +1,8 @@
 import threading
 import queue
+import asyncio
 from ollama import ChatResponse
-from ollama import chat
+from ollama import AsyncClient
 from pynput import keyboard
 import os
 import time
@@ -9,12 +10,51 @@ from lib import epd7in5_V2
 from signal import pause
 from gpiozero import RotaryEncoder
 from PIL import Image, ImageDraw, ImageFont
+import numpy as np
 from enum import Enum, auto
+from functools import lru_cache
 import logging
-import re
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+# Configure logging (set LOG_LEVEL=DEBUG to see per-event messages)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Text measurement caches, keyed by id(font) since ImageFont objects aren't usefully hashable
+_font_by_id = {}
+_measure_draw = ImageDraw.Draw(Image.new('1', (1, 1)))
+
+def _font_id(font):
+    _font_by_id[id(font)] = font
+    return id(font)
+
+@lru_cache(maxsize=4096)
+def _word_width(font_id, word):
+    # textlength is the advance width, so words and spaces can simply be summed
+    return _measure_draw.textlength(word, font=_font_by_id[font_id])
+
+@lru_cache(maxsize=256)
+def _wrap_text(text, font_id, max_width):
+    words = text.split()  # Remove all line breaks and extra spaces
+    space_width = _word_width(font_id, ' ')
+    lines = []
+    current_line = []
+    current_width = 0
+
+    for word in words:
+        word_width = _word_width(font_id, word)
+        test_width = current_width + space_width + word_width if current_line else word_width
+
+        if test_width <= max_width or not current_line:
+            current_line.append(word)
+            current_width = test_width
+        else:
+            lines.append(' '.join(current_line))
+            current_line = [word]  # Start a new line
+            current_width = word_width
+
+    if current_line:
+        lines.append(' '.join(current_line))
+
+    return tuple(lines)
 
 class EventType(Enum):
     LLM_RESPONSE = auto()
@@ -50,11 +90,10 @@ class DeviceController:
         self.current_response = ""
         self.loading_progress = -1
         self.is_running = True
-        # self.llm_output_ready = False 
-        self.loading_bar_full = False 
-        
-        # Lock for thread-safe access to shared state
-        self.state_lock = threading.Lock()
+
+        # Set from handle_event when the final LLM_RESPONSE / BAR_FULL arrive
+        self._llm_ready_evt = threading.Event()
+        self._bar_full_evt = threading.Event()
         
         logging.info("DeviceController initialized successfully.")
     
@@ -62,18 +101,18 @@ class DeviceController:
         """Start all component threads and the main event loop"""
         logging.info("Starting DeviceController threads...")
         
-        # Start component threads
+        # Start component threads (the rotary encoder runs on gpiozero's own callback thread)
         display_thread = threading.Thread(target=self.display.run)
-        rotary_thread = threading.Thread(target=self.rotary.run)
         llm_thread = threading.Thread(target=self.llm.run)
+        redraw_thread = threading.Thread(target=self.llm.redraw_loop)
         
         display_thread.daemon = True
-        rotary_thread.daemon = True
         llm_thread.daemon = True
+        redraw_thread.daemon = True
         
         display_thread.start()
-        rotary_thread.start()
         llm_thread.start()
+        redraw_thread.start()
         
         logging.info("All threads started. Entering event processing loop.")
         
@@ -85,57 +124,98 @@ class DeviceController:
         logging.info("Processing events...")
         try:
             while self.is_running:
-                try:
-                    # Get event with timeout to allow for graceful shutdown
-                    event = self.event_queue.get(timeout=0.1)
-                    logging.debug(f"Event received: {event.type}")
+                # Block until something happens; a SHUTDOWN event ends the loop
+                event = self.event_queue.get()
+                logging.debug("Event received: %s", event.type)
+                events = self.coalesce_bar_updates(event) if event.type == EventType.BAR_UPDATE else [event]
+                for event in events:
                     self.handle_event(event)
                     self.event_queue.task_done()
-                except queue.Empty:
-                    continue
         except KeyboardInterrupt:
             self.shutdown()
+
+    def coalesce_bar_updates(self, event):
+        """Fold every BAR_UPDATE already waiting into one, keeping the furthest progress.
+
+        Returns that update followed by the other events taken off the queue, in arrival order.
+        """
+        others = []
+        while True:
+            try:
+                pending = self.event_queue.get_nowait()
+            except queue.Empty:
+                break
+            if pending.type == EventType.BAR_UPDATE:
+                if pending.data > event.data:
+                    event.data = pending.data
+                self.event_queue.task_done()
+            else:
+                others.append(pending)
+
+        # Handled here rather than put back, so nothing posted meanwhile can overtake them
+        return [event] + others
     
     def handle_event(self, event):
         """Handle events based on their type"""
-        logging.debug(f"Handling event: {event.type}")
+        logging.debug("Handling event: %s", event.type)
+
+        # Input events from before the last Enter are stale
+        if isinstance(event.data, dict) and event.data.get('gen', self.llm.input_generation) != self.llm.input_generation:
+            logging.debug("Dropping stale event: %s", event.type)
+            return
         
         if event.type == EventType.SHUTDOWN:
             logging.info("Shutdown event received.")
             self.shutdown()
 
         elif event.type == EventType.KEYBOARDINPUT:
-            logging.info("Keyboard input event detected.")
+            logging.debug("Keyboard input event detected.")
             self.display.prtext(self.llm.user_input)
 
         elif event.type == EventType.INPUTSENT:
             logging.info("User input sent. Updating display and loading bar.")
             self.display.loadingbar()
             self.display.display_user_input(self.llm.user_input)
+            self.current_response = ""
+            self._llm_ready_evt.clear()  # A reply the user never cranked for must not show up now
+            self._bar_full_evt.clear()
             self.rotary.is_running = True
 
         elif event.type == EventType.BAR_UPDATE:
-            logging.info("Loading bar update event detected.")
-            self.display.update_loading_bar(self.rotary.loading_progress)
+            logging.debug("Loading bar update event detected.")
+            self.display.update_loading_bar(event.data)
 
         elif event.type == EventType.BAR_FULL:
             logging.info("Loading bar full event received.")
-            self.loading_bar_full = True  
+            self._bar_full_evt.set()
+            # Show whatever has streamed in so far, the rest follows line by line
+            self.display.start_response()
+            if not self._llm_ready_evt.is_set():
+                self.display.display_response(self.current_response, final=False)
             self.check_display_response()  
 
         elif event.type == EventType.LLM_RESPONSE:
-            logging.info("LLM Response receieved: {self.current_response}")
-            # self.current_response = self.llm.response #Store response
+            if isinstance(event.data, dict) and 'partial' in event.data:
+                if self._llm_ready_evt.is_set():
+                    return  # The full reply is already in
+                self.current_response = event.data['partial']
+                if self._bar_full_evt.is_set():
+                    self.display.display_response(self.current_response, final=False)
+                return
+
+            self.current_response = event.data  # Full reply (or error text)
+            self._llm_ready_evt.set()
+            logging.info("LLM response received: %s", self.current_response)
             self.check_display_response()
 
     def check_display_response(self):
         #"""Check if both conditions (bar full & LLM response ready) are met before displaying"""
-        if self.llm.llm_output_ready and self.loading_bar_full:
+        if self._llm_ready_evt.is_set() and self._bar_full_evt.is_set():
             logging.info("Both LLM response and loading bar are ready. Displaying response.")
-            self.display.display_response(self.llm.response.message.content)
+            self.display.display_response(self.current_response)
             
-            self.llm.llm_output_ready = False
-            self.loading_bar_full = False
+            self._llm_ready_evt.clear()
+            self._bar_full_evt.clear()
 
     def shutdown(self):
         """Shutdown the application gracefully"""
@@ -144,7 +224,7 @@ class DeviceController:
         
         # Notify components to shut down
         self.display.stop()
-        self.rotary.stop()
+        self.rotary.close()
         self.llm.stop()
         
         logging.info("DeviceController shutdown complete.")
@@ -162,6 +242,7 @@ class EpaperDisplay:
         #initialise the e-paper display settings
         self.epd = epd7in5_V2.EPD()
         self.epd.init()
+        self.enable_fast_spi()
         self.epd.Clear()
 
         # Screen layout settings
@@ -178,9 +259,9 @@ class EpaperDisplay:
 
         self.font_path = "/home/pi/llamalocal/lib/Font.ttc"
         self.font24 = ImageFont.truetype(self.font_path, 24)
-        self.line_height = 28
+        # One font, so one line height for every line; measured once rather than per redraw
+        self.line_height = self.get_line_height("Test", self.font24, _measure_draw)
 
-        self.key_count = 2
         # self.user_input = ""
         self.input_counter = 0
 
@@ -189,6 +270,60 @@ class EpaperDisplay:
         self.draw = ImageDraw.Draw(self.image)
         self.loading_progress = -1  # Progress for loading bar
 
+        # Partial refresh state
+        self.epd.init_fast()
+        self.refresh_mode = "full"  # "full" or "partial", whichever init_* the panel last got
+        self.input_bbox = None  # Area covered by the last drawn "You: ..." text
+        self._input_text = None  # Last drawn "You: ..." string
+        self._wrapped_input_lines = None
+        self._last_line_y = None
+
+        # The intro screen never changes, so draw it once
+        self._intro_image = Image.new('1', (self.EPD_WIDTH, self.EPD_HEIGHT), 255)
+        intro_draw = ImageDraw.Draw(self._intro_image)
+        outer_rect = [(self.margin_x, self.margin_y), 
+            (self.EPD_WIDTH - self.margin_x, self.margin_y + self.loading_bar_height)]
+        intro_draw.rectangle(outer_rect, fill=255, outline=0)
+
+        wrapped_info = self.wrap_text("William Morris: The machine before you is wholly self-contained. Set the wheel in motion, and by your own hand provide the power required to generate a response!", 
+        self.font24, intro_draw, self.epd.width - 40)
+        
+        y_offset = 10
+        for line in wrapped_info:
+            intro_draw.text((20, y_offset), line, font=self.font24, fill=0)
+            y_offset += self.line_height
+
+        # Likewise the bar only has num_bars states: tile i is the bar area with bars 0..i filled
+        self._bar_rects = []
+        self._bar_tiles = []
+        self._bar_buffers = []
+        for i in range(self.num_bars):
+            filled = self._intro_image.copy()
+            ImageDraw.Draw(filled).rectangle([(self.margin_x, self.margin_y), 
+                (self.margin_x + (i + 1) * self.loading_bar_width + 3, self.margin_y + self.loading_bar_height)], fill=0)
+            rect = self.aligned_rect(self.margin_x, self.margin_y, self.margin_x + (i + 1) * self.loading_bar_width + 4,
+                                     self.margin_y + self.loading_bar_height + 1)
+            self._bar_rects.append(rect)
+            self._bar_tiles.append(filled.crop(rect))
+            self._bar_buffers.append(self.pack_image(self._bar_tiles[i]))
+
+    def enable_fast_spi(self):
+        """Run the SPI bus at 16 MHz instead of the driver's 4 MHz"""
+        epdconfig = epd7in5_V2.epdconfig
+        if getattr(epdconfig, 'SPI', None) is None:
+            return  # Not the spidev backend, leave the driver as it is
+
+        # Every init*() goes through module_init(), which sets 4 MHz again, so reapply it there
+        module_init = epdconfig.module_init
+
+        def fast_module_init(*args, **kwargs):
+            result = module_init(*args, **kwargs)
+            epdconfig.SPI.max_speed_hz = 16000000  # Reliable on the Pi with the HAT's short leads
+            return result
+
+        epdconfig.module_init = fast_module_init
+        epdconfig.SPI.max_speed_hz = 16000000
+
     def clear_screen(self):
         # Create a blank image with a white background
         self.image = Image.new('1', (self.EPD_WIDTH, self.EPD_HEIGHT), 255)
@@ -196,57 +331,66 @@ class EpaperDisplay:
 
     def clear_area(self, draw, x, y, width, height):
         draw.rectangle((x, y, x + width, y + height), fill=255)
-    
-    def wrap_text(self, text, font, draw, max_width):
-        text = ' '.join(text.split())  # Remove all line breaks and extra spaces
-        lines = []
-        words = text.split(' ')  # Split into words
-        current_line = []
 
-        for word in words:
-            test_line = ' '.join(current_line + [word])
-            test_width = draw.textbbox((0, 0), test_line, font=font)[2]
+    def union_bbox(self, a, b):
+        if a is None:
+            return b
+        if b is None:
+            return a
+        return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
 
-            if test_width <= max_width:
-                current_line.append(word)
-            else:
-                lines.append(' '.join(current_line))
-                current_line = [word]  # Start a new line
-
-        if current_line:
-            lines.append(' '.join(current_line))
-
-        return lines  # Returns a list of properly wrapped lines
+    def display_full(self):
+        """Push the whole frame buffer with a (fast) full refresh"""
+        if self.refresh_mode != "full":
+            self.epd.init_fast()
+            self.refresh_mode = "full"
+        self.epd.display(self.pack_image(self.image))
+
+    def aligned_rect(self, x0, y0, x1, y1):
+        # The controller addresses 8 pixels per byte, so widen the rect to whole bytes
+        return (max(0, x0 // 8 * 8), max(0, y0), min(self.EPD_WIDTH, -(-x1 // 8) * 8), min(self.EPD_HEIGHT, y1))
+
+    def pack_image(self, image):
+        # Same layout as getbuffer(), but packed by numpy instead of a per-byte Python loop
+        # and for any byte-aligned region: PIL stores 0=black, the panel wants 1=black
+        return np.packbits(~np.asarray(image), axis=1).tobytes()
+
+    def display_partial(self, x0, y0, x1, y1, buffer=None):
+        """Push only the (x0, y0)-(x1, y1) rectangle of the frame buffer (or a prepacked one)"""
+        x0, y0, x1, y1 = self.aligned_rect(x0, y0, x1, y1)
+        if x1 <= x0 or y1 <= y0:
+            return
+
+        if self.refresh_mode != "partial":
+            self.epd.init_part()
+            self.refresh_mode = "partial"
+
+        if buffer is None:
+            buffer = self.pack_image(self.image.crop((x0, y0, x1, y1)))
+        self.epd.display_Partial(buffer, x0, y0, x1, y1)
+    
+    def wrap_text(self, text, font, draw, max_width):
+        # Cached per (text, font, width); the "You: ..." prefix repeats on every keystroke
+        return list(_wrap_text(text, _font_id(font), max_width))  # Returns a list of properly wrapped lines
 
     def get_line_height(self, text, font, draw):
         bbox = draw.textbbox((0, 0), text, font=font)
         return bbox[3] - bbox[1] + 8  # Further increased spacing for better readability
 
     def loadingbar(self):
-        # Draw initial UI
-        self.draw.rectangle((0, 0, self.epd.width, self.epd.height // 2 + 24), fill=255)
-        self.epd.display(self.epd.getbuffer(self.image))
-
-        outer_rect = [(self.margin_x, self.margin_y), 
-            (self.EPD_WIDTH - self.margin_x, self.margin_y + self.loading_bar_height)]
-        self.draw.rectangle(outer_rect, fill=255, outline=0)
-
-        wrapped_info = self.wrap_text("William Morris: The machine before you is wholly self-contained. Set the wheel in motion, and by your own hand provide the power required to generate a response!", 
-        self.font24, self.draw, self.epd.width - 40)
-        
-        y_offset = 10
-        for line in wrapped_info:
-            self.draw.text((20, y_offset), line, font=self.font24, fill=0)
-            y_offset += self.get_line_height(line, self.font24, self.draw)
-
-        self.epd.display(self.epd.getbuffer(self.image))
+        # Draw initial UI from the prerendered intro screen, leaving the user's prompt in place
+        intro_band = (0, 0, self.epd.width, self.epd.height // 2 + 24)
+        self.image.paste(self._intro_image.crop(intro_band), intro_band[:2])
+        self.display_full()
+        self.loading_progress = -1  # Bar is empty again
+        self._wrapped_input_lines = None  # The band can reach into the input area
         time.sleep(2)
 
     def display_user_input(self, current_input):
-
-        # Calculate dynamic line height
-        self.line_height = self.get_line_height("Test", self.font24, self.draw)
-        print("the lineheight is: ", self.line_height)
+        text = f"You: {current_input}"
+        if self._wrapped_input_lines and text.startswith(self._input_text):
+            self.append_user_input(text)
+            return
 
         # Adjust y_offset to move the user input 4 lines up
         user_input_y_offset = self.epd.height - (120 + 4 * self.line_height)
@@ -256,69 +400,99 @@ class EpaperDisplay:
         wrapped_input = self.wrap_text(f"You: {current_input}", self.font24, self.draw, self.epd.width - 40)
         y_offset = user_input_y_offset
 
+        input_bbox = None
         for line in wrapped_input:
+            input_bbox = self.union_bbox(input_bbox, self.draw.textbbox((20, y_offset), line, font=self.font24))
+            self.draw.text((20, y_offset), line, font=self.font24, fill=0)
+            y_offset += self.line_height
+
+        # Only the old and new text areas changed on the panel
+        changed = self.union_bbox(self.input_bbox, input_bbox)
+        self.input_bbox = input_bbox
+        self._input_text = text
+        self._wrapped_input_lines = wrapped_input
+        self._last_line_y = y_offset - self.line_height
+        if changed:
+            self.display_partial(*changed)
+
+    def append_user_input(self, text):
+        """Redraw only the last wrapped line when text was appended to the input"""
+        # Lines before the last one can't change when words are only added at the end
+        last_line = self._wrapped_input_lines[-1]
+        if self._input_text[-1:].isspace():
+            last_line += " "
+        tail_lines = self.wrap_text(last_line + text[len(self._input_text):], self.font24, self.draw, self.epd.width - 40)
+
+        old_bbox = self.draw.textbbox((20, self._last_line_y), self._wrapped_input_lines[-1], font=self.font24)
+        clear_bottom = max(old_bbox[3], self._last_line_y + len(tail_lines) * self.line_height - 1)
+        self.clear_area(self.draw, 20, self._last_line_y, self.epd.width - 40, clear_bottom - self._last_line_y)
+
+        # Descenders of the line above reach into the cleared strip, so draw it again on top
+        if len(self._wrapped_input_lines) > 1:
+            self.draw.text((20, self._last_line_y - self.line_height), self._wrapped_input_lines[-2], font=self.font24, fill=0)
+
+        y_offset = self._last_line_y
+        changed = (old_bbox[0], old_bbox[1], old_bbox[2], clear_bottom)
+        for line in tail_lines:
+            changed = self.union_bbox(changed, self.draw.textbbox((20, y_offset), line, font=self.font24))
             self.draw.text((20, y_offset), line, font=self.font24, fill=0)
             y_offset += self.line_height
 
-        self.epd.display(self.epd.getbuffer(self.image))
+        self.input_bbox = self.union_bbox(self.input_bbox, changed)
+        self._input_text = text
+        self._wrapped_input_lines = self._wrapped_input_lines[:-1] + tail_lines
+        self._last_line_y = y_offset - self.line_height
+        self.display_partial(*changed)
 
     def prtext(self, current_input):
-        self.epd.init_fast()
         self.display_user_input(current_input)
         self.input_counter = 0
 
-    def extract_content(self, response):
-        """Extract only the content from the LLM response, ensuring full capture and proper formatting."""
-
-        # Convert response to string if it's an object
-        if not isinstance(response, str):
-            response = str(response)
-
-        # Regex to find content inside the `content="..."` section
-        match = re.search(r"content=['\"](.*?)(?=['\"], images=|, tool_calls=|\))", response, re.DOTALL)
-
-        if match:
-            extracted_text = match.group(1)
-
-            # Replace escape sequences with proper formatting
-            extracted_text = extracted_text.replace("\\'", "'")  # Convert escaped single quotes to normal ones
-            extracted_text = extracted_text.replace('\\"', '"')  # Convert escaped double quotes to normal ones
+    def start_response(self):
+        """Clear the top half, ready for the reply to be drawn line by line"""
+        self.draw.rectangle((0, 0, self.epd.width, self.epd.height // 2), fill=255)
+        self.response_bbox = (0, 0, self.epd.width, self.epd.height // 2)  # Pushed with the first lines
+        self.response_lines = []  # Lines already on the panel
 
-            # Remove all newlines and ensure spaces remain between words
-            extracted_text = extracted_text.replace("\n", " ")  # Replace ALL newlines with a space
-            extracted_text = extracted_text.replace("\n\n", " ")  # Remove double newlines
-            extracted_text = re.sub(r'\s+', ' ', extracted_text).strip()  # Ensure no extra spaces
+    def draw_response_line(self, line, y):
+        self.draw.text((20, y), line, font=self.font24, fill=0)
+        return self.draw.textbbox((20, y), line, font=self.font24)
 
-            return extracted_text
+    def display_response(self, response, final=True):
+        """Draw the lines of the reply not drawn yet; the last line may still grow until final"""
+        if final:
+            print("in e-paper display class. response is: ", response)
 
-        return response  # Return raw response if no match
+        # Earlier lines don't change as words are appended, so only new ones are drawn
+        self.wrapped_reply = self.wrap_text(f"William Morris: {response}", self.font24, self.draw, self.epd.width - 40)
+        ready_lines = self.wrapped_reply if final else self.wrapped_reply[:-1]
 
-    def display_response(self, response):
-        print("in e-paper display class. response is: ", response)
-        
-        self.draw.rectangle((0, 0, self.epd.width, self.epd.height // 2), fill=255)
-        self.epd.display(self.epd.getbuffer(self.image))
+        # Unless the text was replaced (e.g. an error part-way through the stream): start over
+        if ready_lines[:len(self.response_lines)] != self.response_lines:
+            self.start_response()
 
-        self.wrapped_reply = self.wrap_text(f"William Morris: {response}", self.font24, self.draw, self.epd.width - 40)
-        y_offset = 10
-        for line in self.wrapped_reply:
-            self.draw.text((20, y_offset), line, font=self.font24, fill=0)
-            y_offset += self.line_height
+        changed = self.response_bbox
+        for i in range(len(self.response_lines), len(ready_lines)):
+            changed = self.union_bbox(changed, self.draw_response_line(ready_lines[i], 10 + i * self.line_height))
+            self.response_lines.append(ready_lines[i])
 
-        self.epd.display(self.epd.getbuffer(self.image))
+        self.response_bbox = None
+        if changed:
+            self.display_partial(*changed)
          
     def run(self):
         """Run the display thread"""
         
-        while self.is_running:
+        while True:
+            update_text = self.update_queue.get()
+            if isinstance(update_text, Event) and update_text.type == EventType.SHUTDOWN:
+                self.update_queue.task_done()
+                break
             try:
-                update_text = self.update_queue.get(timeout=0.1)
                 self.update_display(update_text)
-                self.update_queue.task_done()
-            except queue.Empty:
-                continue
             except Exception as e:
                 print(f"Display error: {e}")
+            self.update_queue.task_done()
 
     def queue_update(self, text):
         """Queue a display update from another thread"""
@@ -327,19 +501,17 @@ class EpaperDisplay:
     def stop(self):
         """Stop the display thread"""
         self.is_running = False
+        self.update_queue.put(Event(EventType.SHUTDOWN))  # Wake up run()
 
     def update_loading_bar(self, loading_progress):
-        if loading_progress < self.num_bars:
-            current_x = self.margin_x + (loading_progress * self.loading_bar_width)
-            self.draw.rectangle([(current_x, self.margin_y), 
-                            (current_x + self.loading_bar_width + 3, self.margin_y + self.loading_bar_height)], fill=0)
-            
-            # Refresh display after every 5 full rotations
-            self.epd.init_fast()
-            self.epd.display(self.epd.getbuffer(self.image))
-            time.sleep(2)
+        loading_progress = min(loading_progress, self.num_bars - 1)
+        if loading_progress > self.loading_progress:
+            # The tile holds every bar up to this one, so coalesced updates that skip bars leave no gaps
+            rect = self._bar_rects[loading_progress]
+            self.image.paste(self._bar_tiles[loading_progress], rect[:2])
+            self.display_partial(*rect, buffer=self._bar_buffers[loading_progress])
 
-            self.loading_progress += 1  # Move to the next bar
+            self.loading_progress = loading_progress
 
 # Rotary encoder component
 class RotaryEncoderClass:
@@ -362,12 +534,6 @@ class RotaryEncoderClass:
 
         print("Rotate the encoder to advance the loading bar...")
 
-    def run(self):
-        while True:
-            if self.is_running:
-                self.rotation_detected()
-            time.sleep(0.05)  # Keeps CPU usage low
-
     # **Function to Detect a Full Rotation**
     def rotation_detected(self):
         if self.is_running == True:
@@ -414,20 +580,30 @@ class RotaryEncoderClass:
         self.clkLastState = clkState
         
     def stop(self):
-        """Stop the rotary encoder thread"""
+        """Stop reacting to rotation until the next prompt"""
         self.is_running = False
 
+    def close(self):
+        """Release the encoder pins on shutdown"""
+        self.stop()
+        self.encoder.when_rotated = None
+        self.encoder.close()
+
 class LocalLLM:
     def __init__(self, event_queue):
         self.event_queue = event_queue
         self.prompt_queue = queue.Queue()
         self.is_running = True
         
-        self.key_count = 2
         self.input_counter = 0  
-        self.input_ready = False  
-        self.llm_output_ready = False
-        self.user_input = ""
+        # Keystroke -> redraw handoff. on_press only writes these plain attributes (atomic under the GIL)
+        # and sets _key_event on the first key of a burst, so typing takes no locks after that
+        self._key_event = threading.Event()
+        self._last_key_time = 0
+        self._pending_gen = 0
+        self._input_ready_event = threading.Event()  # Set by on_press when Enter is hit
+        self.input_generation = 0  # Bumped on every Enter so older input events can be ignored
+        self._input_chars = []  # Typed characters, joined only when read
 
         self.system_prompt = {
             'role': 'system',
@@ -440,11 +616,23 @@ class LocalLLM:
             )
         }
         self.messages = [self.system_prompt]
+
+        # Kept open for the whole session; line buffered so every turn still reaches the file
+        self._chat_log = open("/home/pi/Documents/morrisAI/chat_log.txt", "a", buffering=1)
         logging.info("LocalLLM initialized successfully.")   
 
+    @property
+    def user_input(self):
+        return ''.join(self._input_chars)
+
     def run(self):
         """Run the LLM thread."""
         logging.info("Starting LocalLLM thread.")
+
+        # LLM requests run on this thread's own event loop
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.client = AsyncClient()
         
         while self.is_running:
             try:
@@ -453,27 +641,22 @@ class LocalLLM:
                 listener = keyboard.Listener(on_press=self.on_press)
                 listener.start()  # Start it in the background
 
-                while not self.input_ready:
-                    time.sleep(0.1)
+                self._input_ready_event.wait()
 
                 listener.stop()
+                if not self.is_running:
+                    break
 
-                logging.debug(f"User input received: {self.user_input}")
+                logging.debug("User input received: %s", self.user_input)
                 
                 self.messages.append({'role': 'user', 'content': self.user_input})
                 
                 self.response = self.get_llm_response()
                 print("the response is: ", self.response)
-                print(f"formatted response: {self.response.message.content}")
-                with open("/home/pi/Documents/morrisAI/chat_log.txt", "a") as log_file:
-                    log_file.write(f"\nYou: {self.user_input}\n")
-                    log_file.write(f"William Morris: {self.response}\n")
-                self.messages.append({'role': 'assistant', 'content': self.response.message.content})  # Append AI response to history
-                self.llm_output_ready = True
+                self._chat_log.write(f"\nYou: {self.user_input}\nWilliam Morris: {self.response}\n")
+                self.messages.append({'role': 'assistant', 'content': self.response})  # Append AI response to history
                 self.event_queue.put(Event(EventType.LLM_RESPONSE, self.response))
                 
-                self.user_input = ""
-                self.input_ready = False
                 # Ensure task_done is only called if an item was actually taken from the queue
                 if not self.prompt_queue.empty():
                     self.prompt_queue.task_done()
@@ -482,62 +665,103 @@ class LocalLLM:
                 continue
             except Exception as e:
                 logging.error(f"LLM error: {e}")
+                if self.messages[-1]['role'] == 'user':
+                    self.messages.pop()  # Unanswered, so don't send it again with the next prompt
                 self.event_queue.put(Event(EventType.LLM_RESPONSE, f"Error: {str(e)}"))
+            finally:
+                # Ready for the next prompt whether or not this one got a reply
+                self._input_chars.clear()
+                self._input_ready_event.clear()
 
     def on_press(self, key):
         """Handles user keyboard input."""
         try:
             if key.char:
-                self.user_input += key.char
-                self.key_count += 1
-                print(f"[KEYBOARD] Key pressed: {key}")
+                self._input_chars.append(key.char)
+                self.schedule_redraw()
+                logging.debug("Key pressed: %s", key)
         except AttributeError:
             if key == keyboard.Key.space:
-                self.user_input += " "
-                self.key_count += 1
+                self._input_chars.append(" ")
+                self.schedule_redraw()
             elif key == keyboard.Key.backspace:
-                self.user_input = self.user_input[:-1]
-                self.key_count += 1
+                if self._input_chars:
+                    self._input_chars.pop()
+                self.schedule_redraw()
             elif key == keyboard.Key.enter:
                 logging.debug("Enter key pressed. Finalizing input.")
 
-                with self.event_queue.mutex:
-                     self.event_queue.queue.clear()
-
-                print("Queue jumped! Processing only the latest input.")
+                # Pending redraws of the old input are skipped by the controller
+                self.input_generation += 1
                 
-                self.key_count = 0  # Reset counter on Enter
-                self.event_queue.put(Event(EventType.INPUTSENT))
-                self.input_ready = True
+                self.event_queue.put(Event(EventType.INPUTSENT, {'gen': self.input_generation}))
+                self._input_ready_event.set()
+
+    def schedule_redraw(self):
+        """Redraw the input once typing has paused for 250 ms"""
+        self._last_key_time = time.monotonic()
+        self._pending_gen = self.input_generation
+        if not self._key_event.is_set():
+            self._key_event.set()
+
+    def redraw_loop(self):
+        """Post one KEYBOARDINPUT per typing pause"""
+        while self.is_running:
+            self._key_event.wait()
 
-        if self.key_count >= 3:
-            logging.debug("Sending KEYBOARDINPUT event.")
-            self.event_queue.put(Event(EventType.KEYBOARDINPUT))
-            self.input_counter += 1
-            self.key_count = 0
+            # Keep pushing the deadline back while keys are still arriving
+            while True:
+                delay = self._last_key_time + 0.25 - time.monotonic()
+                if delay <= 0:
+                    break
+                time.sleep(delay)
+            self._key_event.clear()
+
+            if self.is_running:
+                logging.debug("Sending KEYBOARDINPUT event.")
+                # Carries the generation it was typed in, so a burst ended by Enter is dropped
+                self.event_queue.put(Event(EventType.KEYBOARDINPUT, {'gen': self._pending_gen}))
+                self.input_counter += 1
 
     def get_llm_response(self):
         """Get response from local LLM API."""
-        logging.info(f"Sending input to LLM: {self.user_input[:30]}...")
+        logging.info("Sending input to LLM: %.30s...", self.user_input)
 
         try:
 
             self.options = {'num_predict': 135}
 
-            response = chat(model='llama3.2:1b', messages=self.messages, options=self.options)  # Get response object
-            self.llm_output_ready = True  
-            logging.debug(f"Response received: {response}")  # Print the full response
+            response = self.loop.run_until_complete(self.stream_llm_response())
+            logging.debug("Response received: %s", response)  # Print the full response
             
             return response  
 
         except Exception as e:
+            # Raised so run() can keep the failure out of the history and the chat log
             logging.error(f"Error getting LLM response: {e}")
-            return f"Error: {str(e)}"
+            raise
+
+    async def stream_llm_response(self):
+        """Stream the reply from the local LLM API and return its full text."""
+        self.response_parts = []  # Grows as tokens arrive
+        stream = await self.client.chat(model='llama3.2:1b', messages=self.messages, options=self.options, stream=True)
+        async for chunk in stream:
+            self.response_parts.append(chunk.message.content)
+
+            # Hand the display every finished word so it can draw completed lines early
+            if any(c.isspace() for c in chunk.message.content):
+                text = ''.join(self.response_parts)
+                partial = text if text[-1].isspace() else text[:len(text) - len(text.split()[-1])]
+                self.event_queue.put(Event(EventType.LLM_RESPONSE, {'partial': partial.rstrip()}))
+        return ''.join(self.response_parts)
 
     def stop(self):
         """Stop the LLM thread."""
         logging.info("Stopping LocalLLM thread.")
         self.is_running = False
+        self._input_ready_event.set()  # Wake up run()
+        self._key_event.set()  # Wake up redraw_loop()
+        self._chat_log.close()
 
 # Example usage
 if __name__ == "__main__":